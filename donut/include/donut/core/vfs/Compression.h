@@ -29,13 +29,15 @@ namespace donut::vfs
 {
     /* 
     Transparent compression and decompression layer for the virtual file system.
-    Currently, it only supports LZ4 frame compression.
+    Currently, it only supports LZ4 frame and LZ4 block compression.
 
     Behavior:
     
     The readFile function tries to read the file with an extra '.lz4' extension
     appended first. If such file exists, it will be decompressed and returned.
-    If no .lz4 file exists, the compression layer will read and return the file
+    Otherwise, it tries the '.lz4b' extension, which denotes a single LZ4 block
+    prefixed with its 32-bit little-endian uncompressed size.
+    If neither exists, the compression layer will read and return the file
     with the exact name requested.
 
     The writeFile function will compress the input data if the provided file name
@@ -43,7 +45,7 @@ namespace donut::vfs
     written uncompressed.
 
     The enumerateFiles function will search for files with the requested extensions
-    and with extra '.lz4' extensions. The .lz4 extensions will be removed from 
+    and with extra '.lz4' or '.lz4b' extensions. These extensions will be removed from 
     the returned file names and de-duplicated in case the same file exists in both
     compressed and uncompressed forms.
 
@@ -24,69 +24,329 @@
 import tarfile
 import os
 import lz4.frame
+import lz4.block
 import argparse
 import sys
 import io
+import json
+import contextlib
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from collections import deque
 
-parser = argparse.ArgumentParser(description = "Tar/LZ4 packaging tool", fromfile_prefix_chars='@')
-parser.add_argument('inputs', nargs = '*')
-parser.add_argument('--output', '-o', required = True, help = "Output file name")
-parser.add_argument('--compress', '-c', default = 0, type = int, help = "LZ4 compression level, 0 = uncompressed")
-parser.add_argument('--prefix', '-p', default = '', help="Path prefix for archive files")
-parser.add_argument('--no-compress', '-n', action = 'append', default = [], help="File types to skip compression for")
+# read size for streaming file contents into the LZ4 compressor
+CHUNK_SIZE = 1 << 20
 
+# write buffer size for the output archive
+OUTPUT_BUFFER_SIZE = 1 << 20
 
-args = parser.parse_args()
+# files below this size are stored as a single LZ4 block in block mode, larger ones still use frames
+BLOCK_MODE_MAX_SIZE = 1 << 20
 
-original_size = 0
-compressed_size = 0
+# outside of block mode, files below this size are stored uncompressed because the frame overhead outweighs the savings
+SMALL_FILE_SIZE = 4096
 
-def normalize_path(path):
-    path = os.path.normpath(path)
-    if args.prefix:
-        path = os.path.join(args.prefix, path)
-    path = path.replace('\\', '/')
-    return path
+# headers of formats that are already compressed and don't benefit from another LZ4 pass
+INCOMPRESSIBLE_MAGICS = (
+    b'\x89PNG',            # PNG
+    b'\xff\xd8\xff',       # JPEG
+    b'PK\x03\x04',         # ZIP
+    b'\x1f\x8b',           # gzip
+    b'BZh',                # bzip2
+    b'\x28\xb5\x2f\xfd',   # zstd
+    b'\x04\x22\x4d\x18',   # LZ4 frame
+)
 
-def process_file(path, tar):
-    global original_size, compressed_size
+# archive paths always use forward slashes
+SLASH_TABLE = str.maketrans('\\', '/')
 
-    archive_path = normalize_path(path)
-    print(archive_path)
-    
-    try:
-        with open(path, 'rb') as file:
-            contents = file.read()
-    except:
-        print("ERROR: Cannot read file: %s" % path)
-        sys.exit(1)
-
-    original_size += len(contents)
-
-    extension = os.path.splitext(path)[1]
+def normalize_prefix(prefix):
+    # turns the --prefix argument into a string that can be prepended to every normalized path
+    if not prefix:
+        return ''
+    return prefix.translate(SLASH_TABLE).rstrip('/') + '/'
 
-    if args.compress and (extension not in args.no_compress):
-        contents = lz4.frame.compress(contents, compression_level = args.compress, store_size = True, return_bytearray = True)
-        archive_path += '.lz4'
+def normalize_path(path, prefix):
+    return prefix + os.path.normpath(path).translate(SLASH_TABLE)
 
-    compressed_size += len(contents)
-
-    tarinfo = tarfile.TarInfo(archive_path)
-    tarinfo.size = len(contents)
-    tar.addfile(tarinfo, io.BytesIO(contents))
-    
-with tarfile.open(args.output, mode = 'w', format = tarfile.USTAR_FORMAT) as tar:
-    for input_name in args.inputs:
+def collect_files(inputs):
+    for input_name in inputs:
         if os.path.isdir(input_name):
             # if the line references a directory, recursively collect everything from that directory
             for dirpath, dirnames, filenames in os.walk(input_name):
                 for file_name in filenames:
-                    path = os.path.join(dirpath, file_name)
-                    process_file(path, tar)
+                    yield os.path.join(dirpath, file_name)
         else:
             # just take one file
-            process_file(input_name, tar)
+            yield input_name
+
+def looks_incompressible(header):
+    return header.startswith(INCOMPRESSIBLE_MAGICS)
+
+# LZ4 frame compression context of the current worker process, reused for every file it compresses
+compression_context = None
+
+def get_compression_context():
+    global compression_context
+    if compression_context is None:
+        compression_context = lz4.frame.create_compression_context()
+    return compression_context
+
+def compress_file_native(path, compression_level, native_lz4):
+    # the lz4 command line tool reads the file itself and writes the frame to stdout,
+    # returns None if it fails so that the caller can fall back to the Python bindings
+    command = [native_lz4, '-z', '-c', '-q', '-%d' % min(compression_level, 12),
+        '-B5', '-BD', '--content-size', '--no-frame-crc', '--', path]
+    result = subprocess.run(command, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
+def compress_file(path, compression_level, block_mode, native_lz4):
+    # runs in a worker process: reads the file there so that only the compressed data is sent back
+    # returns the compressed contents and the extension to append to the archive path, or None to store the file as is;
+    # the contents are returned as bytes, which io.BytesIO in the main process can wrap without making a copy
+    if not compression_level:
+        return None
+
+    file_size = os.stat(path).st_size
+    with open(path, 'rb', buffering = io.DEFAULT_BUFFER_SIZE) as file:
+        if looks_incompressible(file.peek(8)[:8]):
+            return None
+
+        if block_mode and file_size < BLOCK_MODE_MAX_SIZE:
+            # a single block prefixed with the uncompressed size, without the frame header and end mark
+            if compression_level < 0:
+                contents = lz4.block.compress(file.read(), mode = 'fast', acceleration = -compression_level,
+                    store_size = True)
+            elif compression_level < 3:
+                contents = lz4.block.compress(file.read(), mode = 'default', store_size = True)
+            else:
+                contents = lz4.block.compress(file.read(), mode = 'high_compression', compression = compression_level,
+                    store_size = True)
+            return contents, '.lz4b'
+
+        if native_lz4 and compression_level > 0:
+            contents = compress_file_native(path, compression_level, native_lz4)
+            if contents is not None:
+                return contents, '.lz4'
+
+        # feed the file through the frame compressor in chunks so that the whole source never sits in memory
+        context = get_compression_context()
+        chunks = [lz4.frame.compress_begin(context, source_size = file_size,
+            compression_level = compression_level, block_size = lz4.frame.BLOCKSIZE_MAX256KB,
+            content_checksum = False, block_linked = True, auto_flush = False)]
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(lz4.frame.compress_chunk(context, chunk))
+        chunks.append(lz4.frame.compress_flush(context))
+        contents = b''.join(chunks)
+
+    return contents, '.lz4'
+
+def compress_files(jobs, block_mode, native_lz4):
+    # yields the results of compress_file for (path, level) jobs in order,
+    # worker processes are only started if there is anything to compress
+    if not jobs:
+        return
+
+    cpu_count = os.cpu_count() or 1
+
+    # with a single core, worker processes only add startup and transfer costs
+    if cpu_count == 1:
+        for path, level in jobs:
+            yield compress_file(path, level, block_mode, native_lz4)
+        return
+
+    # keep a bounded number of files in flight, so that finished results don't pile up
+    # in memory while the archive writer waits on an earlier, larger file
+    max_pending = 2 * cpu_count
+
+    with ProcessPoolExecutor() as executor:
+        jobs = iter(jobs)
+        pending = deque(executor.submit(compress_file, path, level, block_mode, native_lz4)
+            for path, level in islice(jobs, max_pending))
+
+        while pending:
+            for path, level in islice(jobs, 1):
+                pending.append(executor.submit(compress_file, path, level, block_mode, native_lz4))
+            yield pending.popleft().result()
+
+# fields of an incremental cache entry and their types
+CACHE_ENTRY_FIELDS = { 'mtime': int, 'size': int, 'level': int, 'block_mode': bool,
+    'name': str, 'offset': int, 'length': int }
+
+def is_valid_cache_entry(entry, archive_size):
+    if not isinstance(entry, dict):
+        return False
+    # exact type checks, so that e.g. a bool isn't accepted as an offset
+    if any(type(entry.get(key)) is not field_type for key, field_type in CACHE_ENTRY_FIELDS.items()):
+        return False
+    return entry['offset'] >= 0 and entry['length'] >= 0 and entry['offset'] + entry['length'] <= archive_size
+
+def load_cache(cache_path, archive_path):
+    # returns the file entries recorded by the previous incremental run, or an empty dict if they can't be trusted;
+    # malformed entries are dropped, which makes them cache misses
+    try:
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+        archive_size = os.path.getsize(archive_path)
+        if not isinstance(cache, dict) or cache.get('archive_size') != archive_size:
+            return {}
+        files = cache.get('files')
+        if not isinstance(files, dict):
+            return {}
+        return { path: entry for path, entry in files.items() if is_valid_cache_entry(entry, archive_size) }
+    except (OSError, ValueError):
+        return {}
+
+def add_entry(tar, name, size, fileobj):
+    # appends a file to the archive and returns the offset of its data within the archive
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = size
+    tar.addfile(tarinfo, fileobj)
+    return tar.offset - tarfile.BLOCKSIZE * ((size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Tar/LZ4 packaging tool", fromfile_prefix_chars='@')
+    parser.add_argument('inputs', nargs = '*')
+    parser.add_argument('--output', '-o', required = True, help = "Output file name")
+    parser.add_argument('--compress', '-c', default = 0, type = int, help = "LZ4 compression level, 0 = uncompressed")
+    parser.add_argument('--acceleration', '-a', default = 1, type = int, help = "LZ4 fast mode acceleration when --compress is 0, 1 = uncompressed, >1 = faster with a lower ratio")
+    parser.add_argument('--prefix', '-p', default = '', help="Path prefix for archive files")
+    parser.add_argument('--no-compress', '-n', action = 'append', default = [], help="File types to skip compression for")
+    parser.add_argument('--native', action = 'store_true', help="Use the lz4 command line tool for frame compression if it's available")
+    parser.add_argument('--block-mode', '-b', action = 'store_true', help="Store files under 1 MB as raw LZ4 blocks with a '.lz4b' extension")
+    parser.add_argument('--incremental', '-i', action = 'store_true', help="Reuse data of unchanged files from the previous archive, tracked in <output>.cache")
+
+    args = parser.parse_args()
+
+    if args.acceleration < 1:
+        parser.error("--acceleration must be 1 or greater")
+
+    # the frame and block compressors both treat negative levels as fast mode with that acceleration
+    if args.compress:
+        compression_level = args.compress
+    elif args.acceleration > 1:
+        compression_level = -args.acceleration
+    else:
+        compression_level = 0
+
+    # the native lz4 tool is opt-in and only used for HC levels, fast mode stays in the Python bindings
+    native_lz4 = shutil.which('lz4') if compression_level > 0 and args.native else None
+
+    prefix = normalize_prefix(args.prefix)
+
+    files = []
+    for path in collect_files(args.inputs):
+        try:
+            stat = os.stat(path)
+            files.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            print("ERROR: Cannot read file: %s" % path)
+            sys.exit(1)
+
+    # largest files go first, so that the workers don't end up waiting on a single big file at the end
+    files.sort(key = lambda file: file[1], reverse = True)
+
+    # the cache maps archive paths to the source file state and the location of the stored data in the previous archive
+    cache_path = args.output + '.cache'
+    cache = load_cache(cache_path, args.output) if args.incremental else {}
+    new_cache = {}
+
+    entries = []
+    small_files = 0
+    for path, size, mtime in files:
+        archive_path = normalize_path(path, prefix)
+        level = compression_level if os.path.splitext(path)[1] not in args.no_compress else 0
+        if level and not args.block_mode and size < SMALL_FILE_SIZE:
+            level = 0
+            small_files += 1
+        cached = cache.get(archive_path)
+        if cached and (cached['mtime'], cached['size'], cached['level'], cached['block_mode']) != (mtime, size, level, args.block_mode):
+            cached = None
+        entries.append((path, size, mtime, archive_path, level, cached))
+
+    misses = [entry for entry in entries if entry[5] is None]
+    jobs = [(entry[0], entry[4]) for entry in misses if entry[4]]
+
+    # when data is copied from the previous archive, the new one is written next to it and replaces it at the end
+    reuse_previous = len(misses) < len(entries)
+    output_path = args.output + '.tmp' if reuse_previous else args.output
+
+    original_size = 0
+    compressed_size = 0
+
+    try:
+        # tarfile ignores bufsize outside of stream modes, so give it a file object with a large write buffer instead,
+        # and let it copy uncompressed files in large blocks too
+        with (open(args.output, 'rb') if reuse_previous else contextlib.nullcontext()) as previous_archive, \
+            open(output_path, 'wb', buffering = OUTPUT_BUFFER_SIZE) as output, \
+            tarfile.open(fileobj = output, mode = 'w', format = tarfile.USTAR_FORMAT, copybufsize = CHUNK_SIZE) as tar:
+            # compression runs in parallel, results come back in order and are appended to the archive one by one
+            results = compress_files(jobs, args.block_mode, native_lz4)
+
+            for path, size, mtime, archive_path, level, cached in entries:
+                print(archive_path)
+
+                if cached:
+                    # unchanged since the previous run: copy the stored data straight from the previous archive
+                    name = cached['name']
+                    length = cached['length']
+                    previous_archive.seek(cached['offset'])
+                    offset = add_entry(tar, name, length, previous_archive)
+                else:
+                    try:
+                        result = next(results) if level else None
+                        if result is None:
+                            # stored uncompressed: let tarfile copy straight from the source file
+                            with open(path, 'rb') as file:
+                                name = archive_path
+                                length = os.fstat(file.fileno()).st_size
+                                offset = add_entry(tar, name, length, file)
+                        else:
+                            contents, extension = result
+                            name = archive_path + extension
+                            length = len(contents)
+                            offset = add_entry(tar, name, length, io.BytesIO(contents))
+                            # don't keep the data alive while waiting for the next result
+                            del result, contents
+                    except OSError:
+                        print("ERROR: Cannot read file: %s" % path)
+                        sys.exit(1)
+
+                original_size += size
+                compressed_size += length
+
+                new_cache[archive_path] = { 'mtime': mtime, 'size': size, 'level': level, 'block_mode': args.block_mode,
+                    'name': name, 'offset': offset, 'length': length }
+    except BaseException:
+        # don't leave a partial archive next to the previous one
+        if reuse_previous and os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    if reuse_previous:
+        os.replace(output_path, args.output)
+
+    if args.incremental:
+        with open(cache_path, 'w') as file:
+            json.dump({ 'archive_size': os.path.getsize(args.output), 'files': new_cache }, file)
+    elif os.path.exists(cache_path):
+        # the archive has been rewritten, so the cache of an earlier incremental run no longer matches it
+        os.remove(cache_path)
+
+    if compression_level:
+        if small_files:
+            print("Stored {0:,} files smaller than {1:,} bytes uncompressed".format(small_files, SMALL_FILE_SIZE))
+        # all inputs can be empty files, which are stored without compression
+        ratio = float(original_size) / float(compressed_size) if compressed_size else 1.0
+        print("Original size: {0:,} bytes, compressed size: {1:,} bytes (ratio = {2:.2f}x)"
+            .format(original_size, compressed_size, ratio))
 
-if args.compress:
-    print("Original size: {0:,} bytes, compressed size: {1:,} bytes (ratio = {2:.2f}x)"
-        .format(original_size, compressed_size, float(original_size) / float(compressed_size)))
\ No newline at end of file
+if __name__ == '__main__':
+    main()
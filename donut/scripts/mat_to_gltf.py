@@ -2,21 +2,37 @@
 import json
 import argparse
 import os.path
+import functools
+
+# orjson is much faster than the standard json module on large glTF files, use it for parsing when it's installed
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 parser = argparse.ArgumentParser(description = ".mat.json to .gltf converter")
 parser.add_argument('--mat', '-m', required = True, help = "Input material file")
 parser.add_argument('--gltf', '-g', required = True, help = "Input glTF file")
 parser.add_argument('--out', '-o', required = True, help = "Output glTF file")
 parser.add_argument('--spec-gloss', '-s', action = "store_true", help = "Input materials are in specular-gloss format")
+parser.add_argument('--compact', '-c', action = "store_true", help = "Write the output glTF without indentation and whitespace")
 
 
 args = parser.parse_args()
 
-with open(args.mat, "r") as matfile:
-	mat = json.load(matfile)
+def load_json(path):
+	with open(path, "rb") as file:
+		data = file.read()
+	if orjson:
+		# orjson rejects some inputs that the json module accepts, such as NaN or very large integers
+		try:
+			return orjson.loads(data)
+		except orjson.JSONDecodeError:
+			pass
+	return json.loads(data)
 
-with open(args.gltf, "r") as gltfile:
-	gltf = json.load(gltfile)
+mat = load_json(args.mat)
+gltf = load_json(args.gltf)
 
 
 anyDdsTextures = False
@@ -39,50 +55,77 @@ else:
 	images = []
 	gltf["images"] = images
 
+# lookup tables for images and textures that are already in the glTF, to avoid scanning the lists
+imageIndices = {}
+for imageIndex, image in enumerate(images):
+	if "uri" in image:
+		imageIndices.setdefault(image["uri"], imageIndex)
+
+textureIndicesBySource = {}
+textureIndicesByDdsSource = {}
+def register_texture(texture, textureIndex):
+	if "source" in texture:
+		textureIndicesBySource.setdefault(texture["source"], textureIndex)
+	ddsSource = texture.get("extensions", {}).get("MSFT_texture_dds", {}).get("source")
+	if ddsSource is not None:
+		textureIndicesByDdsSource.setdefault(ddsSource, textureIndex)
+
+for textureIndex, texture in enumerate(textures):
+	register_texture(texture, textureIndex)
+
 def add_image(path):
-	imageIndex = 0
-	for image in images:
-		if image["uri"] == path:
-			return imageIndex
-		imageIndex += 1
+	imageIndex = imageIndices.get(path)
+	if imageIndex is not None:
+		return imageIndex
 	image = { "uri": path }
+	imageIndex = len(images)
 	images.append(image)
+	imageIndices[path] = imageIndex
 	return imageIndex
 
+# the same DDS texture is usually referenced by many materials, only probe the file system once per path
+@functools.lru_cache(maxsize = None)
+def find_non_dds_image(path):
+	for extension in (".png", ".jpg"):
+		testPath = path[:-4] + extension
+		if os.path.exists(testPath):
+			return testPath
+	return None
+
 def add_texture(path):
 	if path.lower().endswith(".dds"):
 		global anyDdsTextures
 		anyDdsTextures = True
 
-		testPath = path[:-4] + ".png"
-		if os.path.exists(testPath):
-			regularImage = add_image(testPath)
+		regularPath = find_non_dds_image(path)
+		if regularPath is not None:
+			regularImage = add_image(regularPath)
 		else:
-			testPath = path[:-4] + ".jpg"
-			if os.path.exists(testPath):
-				regularImage = add_image(testPath)
-			else:
-				print("WARNING: non-DDS texture not found for %s", path)
-				regularImage = None
+			print("WARNING: non-DDS texture not found for %s", path)
+			regularImage = None
 
 		ddsImage = add_image(path)
 	else:
 		regularImage = add_image(path)
 		ddsImage = None
 
-	textureIndex = 0
-	for texture in textures:
-		if texture["source"] == regularImage \
-		or ("extensions" in texture) and texture["extensions"]["MSFT_texture_dds"]["source"] == ddsImage:
-			return textureIndex
-		textureIndex += 1
+	# reuse the first texture that references either of the images
+	matches = []
+	if regularImage is not None and regularImage in textureIndicesBySource:
+		matches.append(textureIndicesBySource[regularImage])
+	if ddsImage is not None and ddsImage in textureIndicesByDdsSource:
+		matches.append(textureIndicesByDdsSource[ddsImage])
+	if matches:
+		return min(matches)
 
 	texture = { }
 	if regularImage is not None:
 		texture["source"] = regularImage
 	if ddsImage is not None:
 		texture["extensions"] = { "MSFT_texture_dds": { "source": ddsImage } }
+	textureIndex = len(textures)
 	textures.append(texture)
+	register_texture(texture, textureIndex)
 	return textureIndex
 
 	
@@ -97,6 +140,12 @@ for matnode in gltf["materials"]:
 		newmatlist.append(matnode)
 		continue
 
+	diffuse = matdef.get("Diffuse")
+	specular = matdef.get("Specular")
+	shininess = matdef.get("Shininess")
+	opacity = matdef.get("Opacity", 1.0)
+	texdefs = matdef.get("Textures") or {}
+
 	if matdef.get("AlphaTested", False):
 		matnode["alphaMode"] = "MASK"
 		matnode["doubleSided"] = True
@@ -117,7 +166,6 @@ for matnode in gltf["materials"]:
 		metalRough = {}
 		matnode["pbrMetallicRoughness"] = metalRough
 
-	texdefs = matdef.get("Textures", {})
 	if texdefs:
 		emissiveTexture = texdefs.get("Emittance")
 		if emissiveTexture:
@@ -144,38 +192,31 @@ for matnode in gltf["materials"]:
 		diffuseTexture = None
 		specularTexture = None
 
+	hasDiffuse = diffuse is not None and len(diffuse) == 3
+	hasSpecular = specular is not None and len(specular) == 3
+
 	if args.spec_gloss:
-		if not diffuseTexture:
-			diffuseFactor = matdef.get("Diffuse")
-			opacity = matdef.get("Opacity", 1.0)
-			if len(diffuseFactor) == 3:
-				diffuseFactor.append(opacity)
-				specGloss["diffuseFactor"] = diffuseFactor
+		if not diffuseTexture and hasDiffuse:
+			specGloss["diffuseFactor"] = diffuse + [opacity]
 
 		if not specularTexture:
-			specularFactor = matdef.get("Specular")
-			if len(specularFactor) == 3:
-				specGloss["specularFactor"] = specularFactor
+			if hasSpecular:
+				specGloss["specularFactor"] = specular
 
-			specGloss["glossinessFactor"] = matdef.get("Shininess")
+			if shininess is not None:
+				specGloss["glossinessFactor"] = shininess
 	else:
-		if not diffuseTexture:
-			diffuseFactor = matdef.get("Diffuse")
-			opacity = matdef.get("Opacity", 1.0)
-			if len(diffuseFactor) == 3:
-				diffuseFactor.append(opacity)
-				metalRough["baseColorFactor"] = diffuseFactor
+		if not diffuseTexture and hasDiffuse:
+			metalRough["baseColorFactor"] = diffuse + [opacity]
 
 		if not specularTexture:
-			specularFactor = matdef.get("Specular")
-			if len(specularFactor) == 3:
-				metallicFactor = 0
-				for i in range(3):
-					metallicFactor += specularFactor[i] / (specularFactor[i] + diffuseFactor[i])
-				metallicFactor /= 3.0
+			if hasSpecular and hasDiffuse:
+				# channels that are black in both diffuse and specular count as non-metallic
+				metallicFactor = sum(s / (s + d) if s + d != 0 else 0.0 for s, d in zip(specular, diffuse)) / 3.0
 				metalRough["metallicFactor"] = metallicFactor
 
-			metalRough["roughnessFactor"] = 1.0 - matdef.get("Shininess")
+			if shininess is not None:
+				metalRough["roughnessFactor"] = 1.0 - shininess
 
 
 
@@ -187,5 +228,10 @@ if anyDdsTextures:
 	extensionsUsed.append("MSFT_texture_dds")
 
 
-with open(args.out, "w") as outfile:
-	outfile.write(json.dumps(gltf, indent = 4))
+# output always goes through the json module, orjson formats numbers differently and would make
+# the result depend on which modules are installed
+with open(args.out, "w", buffering = 1 << 20) as outfile:
+	if args.compact:
+		json.dump(gltf, outfile, separators = (',', ':'))
+	else:
+		json.dump(gltf, outfile, indent = 4)
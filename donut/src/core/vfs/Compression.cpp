@@ -27,6 +27,7 @@
 
 #ifdef DONUT_WITH_LZ4
 #include <lz4frame.h>
+#include <lz4.h>
 #endif
 
 using namespace donut::vfs;
@@ -41,6 +42,67 @@ bool CompressionLayer::fileExists(const std::filesystem::path& name)
     return m_fs->fileExists(name);
 }
 
+#ifdef DONUT_WITH_LZ4
+// Decompresses a single LZ4 block prefixed with its 32-bit little-endian uncompressed size,
+// as written by lz4.block.compress(..., store_size=True) in the Python LZ4 bindings.
+static std::shared_ptr<IBlob> decompressBlock(const std::filesystem::path& name, const IBlob& compressedBlob)
+{
+    const uint8_t* const compressedData = (const uint8_t*)compressedBlob.data();
+    const size_t compressedSize = compressedBlob.size();
+
+    if (compressedSize < sizeof(uint32_t))
+    {
+        donut::log::warning("Failed to decompress LZ4 block for file '%s': the file is too small",
+            name.generic_string().c_str());
+        return nullptr;
+    }
+
+    const uint32_t decompressedSize = uint32_t(compressedData[0])
+        | (uint32_t(compressedData[1]) << 8)
+        | (uint32_t(compressedData[2]) << 16)
+        | (uint32_t(compressedData[3]) << 24);
+
+    if (decompressedSize == 0)
+        return std::make_shared<Blob>(nullptr, 0);
+
+    // LZ4 expands every input byte into at most 255 output bytes, so a larger stored size means the header is corrupted
+    const uint64_t maxDecompressedSize = uint64_t(compressedSize - sizeof(uint32_t)) * 255;
+
+    if (decompressedSize > uint32_t(LZ4_MAX_INPUT_SIZE) || decompressedSize > maxDecompressedSize
+        || compressedSize - sizeof(uint32_t) > size_t(LZ4_COMPRESSBOUND(LZ4_MAX_INPUT_SIZE)))
+    {
+        donut::log::warning("Failed to decompress LZ4 block for file '%s': the stored size of %u bytes is invalid",
+            name.generic_string().c_str(), decompressedSize);
+        return nullptr;
+    }
+
+    uint8_t* decompressedData = (uint8_t*)malloc(decompressedSize);
+
+    if (decompressedData == nullptr)
+    {
+        donut::log::warning("Failed to decompress LZ4 block for file '%s': couldn't allocate %u bytes of memory",
+            name.generic_string().c_str(), decompressedSize);
+        return nullptr;
+    }
+
+    int result = LZ4_decompress_safe((const char*)compressedData + sizeof(uint32_t), (char*)decompressedData,
+        int(compressedSize - sizeof(uint32_t)), int(decompressedSize));
+
+    if (result != int(decompressedSize))
+    {
+        donut::log::warning("Failed to decompress LZ4 block for file '%s': the data is corrupted",
+            name.generic_string().c_str());
+
+        free(decompressedData);
+        return nullptr;
+    }
+
+    auto blob = std::make_shared<Blob>(decompressedData, decompressedSize);
+
+    return std::static_pointer_cast<IBlob>(blob);
+}
+#endif
+
 std::shared_ptr<IBlob> CompressionLayer::readFile(const std::filesystem::path& name)
 {
 #ifdef DONUT_WITH_LZ4
@@ -49,7 +111,16 @@ std::shared_ptr<IBlob> CompressionLayer::readFile(const std::filesystem::path& n
     auto compressedBlob = m_fs->readFile(nameWithExt);
 
     if (!compressedBlob)
+    {
+        std::filesystem::path nameWithBlockExt = name;
+        nameWithBlockExt += ".lz4b";
+        auto compressedBlockBlob = m_fs->readFile(nameWithBlockExt);
+
+        if (compressedBlockBlob)
+            return decompressBlock(name, *compressedBlockBlob);
+
         return m_fs->readFile(name);
+    }
     
     if (compressedBlob->size() == 0)
         return compressedBlob;
@@ -248,7 +319,10 @@ int CompressionLayer::enumerateFiles(const std::filesystem::path& path,
 {
     std::vector<std::string> patchedExtensions = extensions;
     for (const auto& ext : extensions)
+    {
         patchedExtensions.push_back(ext + ".lz4");
+        patchedExtensions.push_back(ext + ".lz4b");
+    }
 
     // use a set to de-duplicate the names in case some file exists
     // in both compressed and uncompressed versions
@@ -259,6 +333,8 @@ int CompressionLayer::enumerateFiles(const std::filesystem::path& path,
         {
             if (string_utils::ends_with(name, ".lz4"))
                 name.remove_suffix(4);
+            else if (string_utils::ends_with(name, ".lz4b"))
+                name.remove_suffix(5);
             
             if (allowDuplicates)
             {